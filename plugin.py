@@ -1,7 +1,10 @@
+import asyncio
 import json
 import re
 import time
-from dataclasses import dataclass
+from collections import OrderedDict
+from bisect import bisect_right
+from dataclasses import dataclass, field
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
 from src.plugin_system import (
@@ -30,33 +33,47 @@ class PromptSplitResult:
     system_suffix: str
 
 
-@dataclass
-class HistoryLine:
-    prefix: str
-    content: str
-
-
-@dataclass
+@dataclass(slots=True)
 class MergedHistoryBlock:
     role: RoleType
-    speaker_key: str
-    lines: List[HistoryLine]
+    speaker_key: Tuple[str, str, RoleType]
+    # user 块为渲染好的整行；assistant 块仅存“时间, 名字:”前缀，发言内容放在 contents
+    lines: List[str]
+    contents: List[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True, slots=True)
+class RuntimeConfig:
+    enabled: bool = True
+    apply_group: bool = True
+    apply_private: bool = True
+    apply_rewrite: bool = True
+    merge_consecutive: bool = True
+    max_context_size_override: int = 0
+    fallback_to_original: bool = True
+    verbose: bool = False
 
 
 _PATCHED: bool = False
 _ORIGINAL_METHODS: Dict[str, Callable[..., Any]] = {}
-_RUNTIME_CONFIG: Dict[str, Any] = {
-    "enabled": True,
-    "apply_group": True,
-    "apply_private": True,
-    "apply_rewrite": True,
-    "merge_consecutive": True,
-    "max_context_size_override": 0,
-    "fallback_to_original": True,
-    "verbose": False,
-}
+_HISTORY_CACHE: "OrderedDict[Tuple[Any, ...], Tuple[float, List[Tuple[RoleType, str]]]]" = OrderedDict()
+_HISTORY_CACHE_MAX_SIZE = 64
+_HISTORY_CACHE_TTL_SECONDS = 3.0
+# 唯一的运行时配置来源，配置刷新时整体替换为新实例
+_RUNTIME_CONFIG = RuntimeConfig()
 
 
+_REWRITE_MARKER_RE = re.compile("现在请你对这句内容进行改写|改写后的回复|你现在想补充说明你刚刚自己的发言内容")
+_RELATIVE_TIME_RE = re.compile(r"(秒前|分钟前|小时前|天前),\s")
+_CLOCK_TIME_RE = re.compile(r"\d{1,2}:\d{2}(?::\d{2})?,\s")
+
+_SUFFIX_START_RE = re.compile(
+    r"^[^\S\n]*(现在|你现在想补充说明|你正在|现在请你对这句内容进行改写|请你根据聊天内容|改写后的回复|你的名字是)",
+    re.MULTILINE,
+)
+
+_PICID_RE = re.compile(r"\[picid:[^\]]+\]")
+
 _TIMESTAMP_LINE_RE = re.compile(
     r"^\s*(\[[^\]]+\])?(刚刚|\d+秒前|\d+分钟前|\d+小时前|\d+天前|"
     r"\d{1,2}:\d{2}(?::\d{2})?|\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}(?::\d{2})?),\s+.+$"
@@ -64,117 +81,164 @@ _TIMESTAMP_LINE_RE = re.compile(
 
 
 def _debug_log(text: str) -> None:
-    if _RUNTIME_CONFIG.get("verbose", False):
+    if _RUNTIME_CONFIG.verbose:
         logger.info(text)
 
 
 def _is_rewrite_prompt(prompt: str) -> bool:
-    markers = [
-        "现在请你对这句内容进行改写",
-        "改写后的回复",
-        "你现在想补充说明你刚刚自己的发言内容",
-    ]
-    return any(marker in prompt for marker in markers)
+    return _REWRITE_MARKER_RE.search(prompt) is not None
 
 
-def _should_apply_for_stream(chat_stream: Any) -> bool:
+def _should_apply_for_stream(chat_stream: Any, config: RuntimeConfig) -> bool:
     is_group = bool(getattr(chat_stream, "group_info", None))
     if is_group:
-        return bool(_RUNTIME_CONFIG.get("apply_group", True))
-    return bool(_RUNTIME_CONFIG.get("apply_private", True))
+        return config.apply_group
+    return config.apply_private
 
 
 def _resolve_context_limit() -> int:
-    override = int(_RUNTIME_CONFIG.get("max_context_size_override", 0) or 0)
+    override = _RUNTIME_CONFIG.max_context_size_override
     if override > 0:
         return override
     return int(global_config.chat.max_context_size)
 
 
 def _infer_time_mode(prompt: str) -> str:
-    if re.search(r"(秒前|分钟前|小时前|天前),\s", prompt):
+    if _RELATIVE_TIME_RE.search(prompt):
         return "relative"
-    if re.search(r"\d{1,2}:\d{2}(?::\d{2})?,\s", prompt):
+    if _CLOCK_TIME_RE.search(prompt):
         return "normal_no_YMD"
     return "relative"
 
 
 def _split_prompt_blocks(prompt: str) -> Optional[PromptSplitResult]:
-    lines = prompt.splitlines()
-    if not lines:
+    offsets = _line_offsets(prompt)
+    if not offsets:
         return None
 
     # 方案1：基于“当前时间：”锚点（reply 路径）
-    time_line_index = next((idx for idx, line in enumerate(lines) if line.strip().startswith("当前时间：")), None)
+    time_line_index = _find_line_with_prefix(prompt, offsets, "当前时间：")
     if time_line_index is not None:
         history_start = time_line_index + 1
-        history_end = _find_suffix_start(lines, history_start)
+        history_end = _find_suffix_start(prompt, offsets, history_start)
         if history_end is None:
-            history_end = len(lines)
+            history_end = len(offsets)
 
-        system_prefix = "\n".join(lines[:history_start]).strip()
-        system_suffix = "\n".join(lines[history_end:]).strip()
-        if system_prefix or system_suffix:
-            return PromptSplitResult(system_prefix=system_prefix, system_suffix=system_suffix)
+        split_result = _slice_prompt(prompt, offsets, history_start, history_end)
+        if split_result:
+            return split_result
 
     # 方案2：基于聊天头锚点（rewrite 路径）
     header_keywords = ("下面是群里正在聊的内容", "这是你们之前聊的内容")
-    header_index = next((idx for idx, line in enumerate(lines) if any(key in line for key in header_keywords)), None)
+    header_index = _find_line_containing(prompt, offsets, header_keywords)
     if header_index is not None:
         history_start = header_index + 1
-        while history_start < len(lines) and not lines[history_start].strip():
+        while history_start < len(offsets) and not _line_at(prompt, offsets, history_start).strip():
             history_start += 1
-        history_end = _find_suffix_start(lines, history_start)
+        history_end = _find_suffix_start(prompt, offsets, history_start)
         if history_end is None:
-            history_end = len(lines)
+            history_end = len(offsets)
 
-        system_prefix = "\n".join(lines[:history_start]).strip()
-        system_suffix = "\n".join(lines[history_end:]).strip()
-        if system_prefix or system_suffix:
-            return PromptSplitResult(system_prefix=system_prefix, system_suffix=system_suffix)
+        split_result = _slice_prompt(prompt, offsets, history_start, history_end)
+        if split_result:
+            return split_result
 
     # 方案3：兜底扫描时间轴块
-    fallback = _fallback_split_by_timeline(lines)
+    fallback = _fallback_split_by_timeline(prompt, offsets)
     if fallback:
         return fallback
 
     return None
 
 
-def _find_suffix_start(lines: List[str], start_index: int) -> Optional[int]:
-    suffix_prefixes = (
-        "现在",
-        "你现在想补充说明",
-        "你正在",
-        "现在请你对这句内容进行改写",
-        "请你根据聊天内容",
-        "改写后的回复",
-        "你的名字是",
-    )
-    for idx in range(start_index, len(lines)):
-        stripped = lines[idx].strip()
-        if stripped.startswith(suffix_prefixes):
-            return idx
+def _line_offsets(prompt: str) -> List[Tuple[int, int]]:
+    # 只记录每行在原串中的 (start, end)，按需切片，避免 splitlines + join 反复复制整段 prompt
+    offsets: List[Tuple[int, int]] = []
+    pos = 0
+    length = len(prompt)
+    while pos < length:
+        end = prompt.find("\n", pos)
+        if end < 0:
+            end = length
+        offsets.append((pos, end))
+        pos = end + 1
+    return offsets
+
+
+def _line_at(prompt: str, offsets: List[Tuple[int, int]], index: int) -> str:
+    start, end = offsets[index]
+    return prompt[start:end]
+
+
+def _line_index_at(offsets: List[Tuple[int, int]], pos: int) -> int:
+    return bisect_right(offsets, pos, key=lambda item: item[0]) - 1
+
+
+def _find_line_with_prefix(prompt: str, offsets: List[Tuple[int, int]], marker: str) -> Optional[int]:
+    pos = prompt.find(marker)
+    while pos >= 0:
+        index = _line_index_at(offsets, pos)
+        if not prompt[offsets[index][0]:pos].strip():
+            return index
+        pos = prompt.find(marker, pos + 1)
     return None
 
 
-def _fallback_split_by_timeline(lines: List[str]) -> Optional[PromptSplitResult]:
+def _find_line_containing(prompt: str, offsets: List[Tuple[int, int]], keywords: Tuple[str, ...]) -> Optional[int]:
+    positions = [pos for pos in (prompt.find(key) for key in keywords) if pos >= 0]
+    if not positions:
+        return None
+    return _line_index_at(offsets, min(positions))
+
+
+def _slice_prompt(
+    prompt: str,
+    offsets: List[Tuple[int, int]],
+    history_start: int,
+    history_end: int,
+) -> Optional[PromptSplitResult]:
+    prefix_end = offsets[history_start][0] if history_start < len(offsets) else len(prompt)
+    suffix_start = offsets[history_end][0] if history_end < len(offsets) else len(prompt)
+
+    system_prefix = prompt[:prefix_end].strip()
+    system_suffix = prompt[suffix_start:].strip()
+    if not system_prefix and not system_suffix:
+        return None
+
+    return PromptSplitResult(system_prefix=system_prefix, system_suffix=system_suffix)
+
+
+def _find_suffix_start(prompt: str, offsets: List[Tuple[int, int]], start_index: int) -> Optional[int]:
+    if start_index >= len(offsets):
+        return None
+    match = _SUFFIX_START_RE.search(prompt, offsets[start_index][0])
+    if match is None:
+        return None
+    return _line_index_at(offsets, match.start())
+
+
+def _fallback_split_by_timeline(prompt: str, offsets: List[Tuple[int, int]]) -> Optional[PromptSplitResult]:
     best_start: Optional[int] = None
     best_end: Optional[int] = None
     current_start: Optional[int] = None
     timestamp_count = 0
     best_score = -1
 
+    # 单次扫描预先标记每行是否带时间戳，状态机中不再重复匹配
+    lines = [_line_at(prompt, offsets, idx).strip() for idx in range(len(offsets))]
+    timestamped = [_is_timestamped_line(line) for line in lines]
+
     for idx in range(len(lines) + 1):
         is_end = idx == len(lines)
-        line = "" if is_end else lines[idx].strip()
-        is_history_line = _is_history_like_line(line, has_open_block=current_start is not None)
-
-        if not is_end and is_history_line:
+        if not is_end and _is_history_like_line(
+            lines[idx],
+            is_timestamped=timestamped[idx],
+            has_open_block=current_start is not None,
+        ):
             if current_start is None:
                 current_start = idx
                 timestamp_count = 0
-            if _is_timestamped_line(line):
+            if timestamped[idx]:
                 timestamp_count += 1
             continue
 
@@ -190,18 +254,13 @@ def _fallback_split_by_timeline(lines: List[str]) -> Optional[PromptSplitResult]
     if best_start is None or best_end is None:
         return None
 
-    system_prefix = "\n".join(lines[:best_start]).strip()
-    system_suffix = "\n".join(lines[best_end:]).strip()
-    if not system_prefix and not system_suffix:
-        return None
-
-    return PromptSplitResult(system_prefix=system_prefix, system_suffix=system_suffix)
+    return _slice_prompt(prompt, offsets, best_start, best_end)
 
 
-def _is_history_like_line(line: str, has_open_block: bool) -> bool:
+def _is_history_like_line(line: str, is_timestamped: bool, has_open_block: bool) -> bool:
     if not line:
         return has_open_block
-    if _is_timestamped_line(line):
+    if is_timestamped:
         return True
     if line == "图片信息：":
         return True
@@ -216,20 +275,49 @@ def _is_timestamped_line(line: str) -> bool:
     return bool(_TIMESTAMP_LINE_RE.match(line))
 
 
-def _resolve_speaker_name(message: Any) -> str:
+def _resolve_person_name(platform: str, user_id: str) -> str:
+    try:
+        person_name = Person(platform=platform, user_id=user_id).person_name
+        if person_name:
+            return str(person_name)
+    except Exception:
+        pass
+    return ""
+
+
+async def _resolve_person_names(messages: List[Any]) -> Dict[Tuple[str, str], str]:
+    senders: List[Tuple[str, str]] = []
+    seen: set = set()
+    for message in messages:
+        platform = str(getattr(message.user_info, "platform", "") or "")
+        user_id = str(getattr(message.user_info, "user_id", "") or "")
+        sender_key = (platform, user_id)
+        if not platform or not user_id or sender_key in seen:
+            continue
+        seen.add(sender_key)
+        if not is_bot_self(platform, user_id):
+            senders.append(sender_key)
+
+    if not senders:
+        return {}
+
+    # Person 构造可能查库，放到线程中按发送者并发解析，避免逐个阻塞事件循环
+    person_names = await asyncio.gather(
+        *(asyncio.to_thread(_resolve_person_name, platform, user_id) for platform, user_id in senders)
+    )
+    return dict(zip(senders, person_names))
+
+
+def _resolve_speaker_name(message: Any, role: RoleType, person_names: Dict[Tuple[str, str], str]) -> str:
     platform = str(getattr(message.user_info, "platform", "") or "")
     user_id = str(getattr(message.user_info, "user_id", "") or "")
 
-    if is_bot_self(platform, user_id):
+    if role == RoleType.Assistant:
         return f"{global_config.bot.nickname}(你)"
 
-    try:
-        if platform and user_id:
-            person_name = Person(platform=platform, user_id=user_id).person_name
-            if person_name:
-                return str(person_name)
-    except Exception:
-        pass
+    person_name = person_names.get((platform, user_id))
+    if person_name:
+        return person_name
 
     nickname = str(getattr(message.user_info, "user_nickname", "") or "")
     card_name = str(getattr(message.user_info, "user_cardname", "") or "")
@@ -250,41 +338,142 @@ def _normalize_message_content(message: Any) -> str:
     content = replace_user_references(raw_content, platform, replace_bot_name=True)
 
     # 结构化历史里不保留 picid 原始令牌，统一为图片占位
-    content = re.sub(r"\[picid:[^\]]+\]", "[图片]", content)
+    if "[picid:" in content:
+        content = _PICID_RE.sub("[图片]", content)
     return content.strip()
 
 
-def _build_history_blocks(messages: List[Any], time_mode: str) -> List[MergedHistoryBlock]:
+def _collect_history_entries(messages: List[Any]) -> List[Tuple[Any, str]]:
+    entries: List[Tuple[Any, str]] = []
+    for message in messages:
+        content = _normalize_message_content(message)
+        if content:
+            entries.append((message, content))
+    return entries
+
+
+def _build_history_blocks(
+    entries: List[Tuple[Any, str]],
+    time_mode: str,
+    person_names: Dict[Tuple[str, str], str],
+) -> List[MergedHistoryBlock]:
     merged_blocks: List[MergedHistoryBlock] = []
-    merge_consecutive = bool(_RUNTIME_CONFIG.get("merge_consecutive", True))
+    merge_consecutive = _RUNTIME_CONFIG.merge_consecutive
 
-    for message in messages:
+    # 同一次构建内按账号缓存身份判定、按整秒缓存时间文本；昵称/群名片兜底仍逐条取自消息本身
+    role_cache: Dict[Tuple[str, str], RoleType] = {}
+    time_cache: Dict[int, str] = {}
+
+    for message, content in entries:
         platform = str(getattr(message.user_info, "platform", "") or "")
         user_id = str(getattr(message.user_info, "user_id", "") or "")
-        role = RoleType.Assistant if is_bot_self(platform, user_id) else RoleType.User
 
-        content = _normalize_message_content(message)
-        if not content:
-            continue
+        # 缺少 platform 或 user_id 时无法区分账号，不参与缓存
+        cacheable = bool(platform and user_id)
+        role = role_cache.get((platform, user_id)) if cacheable else None
+        if role is None:
+            role = RoleType.Assistant if is_bot_self(platform, user_id) else RoleType.User
+            if cacheable:
+                role_cache[(platform, user_id)] = role
+        speaker = _resolve_speaker_name(message, role, person_names)
 
         timestamp = getattr(message, "time", 0.0)
         if not isinstance(timestamp, (float, int)) or timestamp <= 0:
             timestamp = time.time()
-        readable_time = translate_timestamp_to_human_readable(float(timestamp), mode=time_mode)
+        time_key = int(timestamp)
+        readable_time = time_cache.get(time_key)
+        if readable_time is None:
+            readable_time = translate_timestamp_to_human_readable(float(timestamp), mode=time_mode)
+            time_cache[time_key] = readable_time
 
-        speaker = _resolve_speaker_name(message)
-        history_line = HistoryLine(prefix=f"{readable_time}, {speaker}:", content=content)
-        speaker_key = f"{platform}:{user_id}:{role.value}"
+        prefix = f"{readable_time}, {speaker}:"
+        is_assistant = role == RoleType.Assistant
+        line = prefix if is_assistant else f"{prefix} {content}"
+        speaker_key = (platform, user_id, role)
 
         if merge_consecutive and merged_blocks and merged_blocks[-1].speaker_key == speaker_key:
-            merged_blocks[-1].lines.append(history_line)
+            last_block = merged_blocks[-1]
+            last_block.lines.append(line)
+            if is_assistant:
+                last_block.contents.append(content)
         else:
-            merged_blocks.append(MergedHistoryBlock(role=role, speaker_key=speaker_key, lines=[history_line]))
+            merged_blocks.append(
+                MergedHistoryBlock(
+                    role=role,
+                    speaker_key=speaker_key,
+                    lines=[line],
+                    contents=[content] if is_assistant else [],
+                )
+            )
 
     return merged_blocks
 
 
-def _build_structured_messages(self_obj: Any, prompt: str) -> Optional[List[Tuple[RoleType, str]]]:
+def _render_history_blocks(history_blocks: List[MergedHistoryBlock]) -> List[Tuple[RoleType, str]]:
+    rendered: List[Tuple[RoleType, str]] = []
+    for block in history_blocks:
+        if block.role == RoleType.Assistant:
+            rendered.append((RoleType.User, "\n".join(block.lines)))
+            rendered.append((RoleType.Assistant, "\n".join(block.contents)))
+            continue
+
+        rendered.append((block.role, "\n".join(block.lines)))
+    return rendered
+
+
+def _history_cache_key(
+    stream_id: str,
+    messages: List[Any],
+    context_limit: int,
+    time_mode: str,
+) -> Optional[Tuple[Any, ...]]:
+    # 以窗口内消息的 (message_id, time) 序列标识历史是否变化，比重新渲染整段历史便宜得多；
+    # 任一消息缺少 message_id 时无法可靠区分窗口，直接不缓存
+    message_marks: List[Tuple[str, Any]] = []
+    for message in messages:
+        message_id = str(getattr(message, "message_id", "") or "")
+        if not message_id:
+            return None
+        message_marks.append((message_id, getattr(message, "time", 0.0)))
+
+    return (
+        stream_id,
+        context_limit,
+        time_mode,
+        _RUNTIME_CONFIG.merge_consecutive,
+        tuple(message_marks),
+    )
+
+
+def _lookup_history_cache(key: Optional[Tuple[Any, ...]]) -> Optional[List[Tuple[RoleType, str]]]:
+    if key is None:
+        return None
+
+    entry = _HISTORY_CACHE.get(key)
+    if entry is None:
+        return None
+
+    created_at, history_part = entry
+    # 相对时间文本会随时间推移变化，只在很短的窗口内复用
+    if time.monotonic() - created_at > _HISTORY_CACHE_TTL_SECONDS:
+        _HISTORY_CACHE.pop(key, None)
+        return None
+
+    _HISTORY_CACHE.move_to_end(key)
+    return history_part
+
+
+def _store_history_cache(key: Optional[Tuple[Any, ...]], history_part: List[Tuple[RoleType, str]]) -> None:
+    if key is None:
+        return
+
+    _HISTORY_CACHE[key] = (time.monotonic(), history_part)
+    _HISTORY_CACHE.move_to_end(key)
+    while len(_HISTORY_CACHE) > _HISTORY_CACHE_MAX_SIZE:
+        _HISTORY_CACHE.popitem(last=False)
+
+
+async def _build_structured_messages(self_obj: Any, prompt: str) -> Optional[List[Tuple[RoleType, str]]]:
     split_result = _split_prompt_blocks(prompt)
     if split_result is None:
         _debug_log("[LLM消息守卫] 未能从prompt中拆分system前后段，准备回退")
@@ -308,35 +497,28 @@ def _build_structured_messages(self_obj: Any, prompt: str) -> Optional[List[Tupl
         return None
 
     time_mode = _infer_time_mode(prompt)
-    history_blocks = _build_history_blocks(history_messages, time_mode=time_mode)
-    if not history_blocks:
-        _debug_log("[LLM消息守卫] 历史消息构建为空，准备回退")
-        return None
+    cache_key = _history_cache_key(stream_id, history_messages, context_limit, time_mode)
+    history_part = _lookup_history_cache(cache_key)
+    if history_part is None:
+        # 先剔除清洗后为空的消息，只为真正会出现在历史里的发送者查询 Person
+        history_entries = _collect_history_entries(history_messages)
+        if not history_entries:
+            _debug_log("[LLM消息守卫] 历史消息构建为空，准备回退")
+            return None
+        person_names = await _resolve_person_names([message for message, _content in history_entries])
+        history_blocks = _build_history_blocks(history_entries, time_mode=time_mode, person_names=person_names)
+        history_part = _render_history_blocks(history_blocks)
+        # 查询与写入之间会 await Person 解析，同一窗口的并发请求可能各自构建一次；
+        # 构建结果只取决于缓存键，后写入者覆盖先写入者即可，不需要加锁
+        _store_history_cache(cache_key, history_part)
+    else:
+        _debug_log(f"[LLM消息守卫] 复用结构化历史缓存: stream_id={stream_id}")
 
     messages: List[Tuple[RoleType, str]] = []
     if split_result.system_prefix:
         messages.append((RoleType.System, split_result.system_prefix))
 
-    for block in history_blocks:
-        if block.role == RoleType.Assistant:
-            assistant_prefix = [line.prefix for line in block.lines if line.prefix]
-            assistant_content = [line.content for line in block.lines if line.content]
-
-            if assistant_prefix:
-                messages.append((RoleType.User, "\n".join(assistant_prefix)))
-            if assistant_content:
-                messages.append((RoleType.Assistant, "\n".join(assistant_content)))
-            continue
-
-        history_lines: List[str] = []
-        for line in block.lines:
-            if line.content:
-                history_lines.append(f"{line.prefix} {line.content}")
-            else:
-                history_lines.append(line.prefix)
-
-        if history_lines:
-            messages.append((block.role, "\n".join(history_lines)))
+    messages.extend(history_part)
 
     if split_result.system_suffix:
         messages.append((RoleType.System, split_result.system_suffix))
@@ -348,44 +530,41 @@ def _build_structured_messages(self_obj: Any, prompt: str) -> Optional[List[Tupl
     return messages
 
 
-def _make_patched_llm_generate_content(target_key: str):
+def _make_patched_llm_generate_content(target_key: str, original_method: Callable[..., Any]):
     async def _patched(self_obj: Any, prompt: str):
-        original_method = _ORIGINAL_METHODS.get(target_key)
-        if not original_method:
-            raise RuntimeError(f"缺少原始方法引用: {target_key}")
+        config = _RUNTIME_CONFIG
 
-        if not bool(_RUNTIME_CONFIG.get("enabled", True)):
+        if not config.enabled:
             return await original_method(self_obj, prompt)
 
-        if not _should_apply_for_stream(getattr(self_obj, "chat_stream", None)):
+        if not _should_apply_for_stream(getattr(self_obj, "chat_stream", None), config):
             return await original_method(self_obj, prompt)
 
-        if _is_rewrite_prompt(prompt) and not bool(_RUNTIME_CONFIG.get("apply_rewrite", True)):
+        if not config.apply_rewrite and _is_rewrite_prompt(prompt):
             return await original_method(self_obj, prompt)
 
         try:
-            structured_messages = _build_structured_messages(self_obj, prompt)
+            structured_messages = await _build_structured_messages(self_obj, prompt)
             if not structured_messages:
-                if bool(_RUNTIME_CONFIG.get("fallback_to_original", True)):
+                if config.fallback_to_original:
                     return await original_method(self_obj, prompt)
                 raise RuntimeError("结构化消息构建失败，且已关闭回退")
 
             cleaned_messages: List[Tuple[RoleType, str]] = []
-            debug_messages_payload: List[Dict[str, str]] = []
             for role, text in structured_messages:
                 content = text.strip()
                 if not content:
                     continue
                 cleaned_messages.append((role, content))
-                debug_messages_payload.append({"role": role.value, "content": content})
 
             if not cleaned_messages:
-                if bool(_RUNTIME_CONFIG.get("fallback_to_original", True)):
+                if config.fallback_to_original:
                     return await original_method(self_obj, prompt)
                 raise RuntimeError("结构化消息清洗后为空，且已关闭回退")
 
-            if _RUNTIME_CONFIG.get("verbose", False):
-                request_payload = {"messages": debug_messages_payload}
+            if config.verbose:
+                # 调试用请求体只在 verbose 下构建与序列化，正常请求不承担这部分开销
+                request_payload = {"messages": [{"role": role.value, "content": content} for role, content in cleaned_messages]}
                 logger.info(
                     "[LLM消息守卫] 结构化请求体(messages)如下:\n"
                     + json.dumps(request_payload, ensure_ascii=False, indent=2)
@@ -409,7 +588,7 @@ def _make_patched_llm_generate_content(target_key: str):
 
         except Exception as exc:
             logger.warning(f"[LLM消息守卫] 结构化请求失败: {exc}")
-            if bool(_RUNTIME_CONFIG.get("fallback_to_original", True)):
+            if config.fallback_to_original:
                 return await original_method(self_obj, prompt)
             raise
 
@@ -445,8 +624,12 @@ def _apply_monkey_patch() -> Tuple[bool, str]:
         _ORIGINAL_METHODS["group"] = group_class.llm_generate_content
         _ORIGINAL_METHODS["private"] = private_class.llm_generate_content
 
-        group_class.llm_generate_content = _make_patched_llm_generate_content("group")  # type: ignore[method-assign]
-        private_class.llm_generate_content = _make_patched_llm_generate_content("private")  # type: ignore[method-assign]
+        group_class.llm_generate_content = _make_patched_llm_generate_content(  # type: ignore[method-assign]
+            "group", _ORIGINAL_METHODS["group"]
+        )
+        private_class.llm_generate_content = _make_patched_llm_generate_content(  # type: ignore[method-assign]
+            "private", _ORIGINAL_METHODS["private"]
+        )
 
         _PATCHED = True
         return True, "运行时补丁应用成功"
@@ -472,6 +655,7 @@ def _restore_monkey_patch() -> Tuple[bool, str]:
             private_class.llm_generate_content = private_original  # type: ignore[method-assign]
 
         _ORIGINAL_METHODS.clear()
+        _HISTORY_CACHE.clear()
         _PATCHED = False
         return True, "运行时补丁已恢复"
     except Exception as exc:
@@ -479,14 +663,18 @@ def _restore_monkey_patch() -> Tuple[bool, str]:
 
 
 def _refresh_runtime_config(handler: BaseEventHandler) -> None:
-    _RUNTIME_CONFIG["enabled"] = bool(handler.get_config("plugin.enabled", True))
-    _RUNTIME_CONFIG["apply_group"] = bool(handler.get_config("runtime.apply_group", True))
-    _RUNTIME_CONFIG["apply_private"] = bool(handler.get_config("runtime.apply_private", True))
-    _RUNTIME_CONFIG["apply_rewrite"] = bool(handler.get_config("runtime.apply_rewrite", True))
-    _RUNTIME_CONFIG["merge_consecutive"] = bool(handler.get_config("runtime.merge_consecutive", True))
-    _RUNTIME_CONFIG["max_context_size_override"] = int(handler.get_config("runtime.max_context_size_override", 0) or 0)
-    _RUNTIME_CONFIG["fallback_to_original"] = bool(handler.get_config("runtime.fallback_to_original", True))
-    _RUNTIME_CONFIG["verbose"] = bool(handler.get_config("log.verbose", False))
+    global _RUNTIME_CONFIG
+
+    _RUNTIME_CONFIG = RuntimeConfig(
+        enabled=bool(handler.get_config("plugin.enabled", True)),
+        apply_group=bool(handler.get_config("runtime.apply_group", True)),
+        apply_private=bool(handler.get_config("runtime.apply_private", True)),
+        apply_rewrite=bool(handler.get_config("runtime.apply_rewrite", True)),
+        merge_consecutive=bool(handler.get_config("runtime.merge_consecutive", True)),
+        max_context_size_override=int(handler.get_config("runtime.max_context_size_override", 0) or 0),
+        fallback_to_original=bool(handler.get_config("runtime.fallback_to_original", True)),
+        verbose=bool(handler.get_config("log.verbose", False)),
+    )
 
 
 class RuntimePatchOnStart(BaseEventHandler):
@@ -497,7 +685,7 @@ class RuntimePatchOnStart(BaseEventHandler):
     async def execute(self, message: MaiMessages | None) -> Tuple[bool, bool, Optional[str], None, None]:
         _refresh_runtime_config(self)
 
-        if not _RUNTIME_CONFIG.get("enabled", True):
+        if not _RUNTIME_CONFIG.enabled:
             _debug_log("[LLM消息守卫] 插件配置为禁用，跳过补丁应用")
             return True, True, "插件已禁用，跳过补丁应用", None, None
 
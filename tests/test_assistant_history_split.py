@@ -1,257 +1,572 @@
+import asyncio
+import contextlib
+import dataclasses
+import functools
+import importlib.abc
 import importlib.util
 import sys
 import types
 import unittest
 from enum import Enum
 from pathlib import Path
+from typing import Dict
+from unittest import mock
 
 
 PLUGIN_PATH = Path(__file__).resolve().parents[1] / "plugin.py"
+_PLUGIN_SOURCE = PLUGIN_PATH.read_bytes()
+_PLUGIN_CODE = compile(_PLUGIN_SOURCE, str(PLUGIN_PATH), "exec")
 
 
-def _install_stub_modules() -> None:
-    src_pkg = types.ModuleType("src")
-    src_pkg.__path__ = []
-    sys.modules["src"] = src_pkg
+class BasePlugin:
+    pass
 
-    plugin_system = types.ModuleType("src.plugin_system")
 
-    class BasePlugin:
-        pass
+class BaseEventHandler:
+    pass
+
 
-    class BaseEventHandler:
-        def get_config(self, _key, default=None):
-            return default
+class ComponentInfo:
+    pass
 
-    class ComponentInfo:
+
+class ConfigField:
+    def __init__(self, **_kwargs):
         pass
 
-    class ConfigField:
-        def __init__(self, **kwargs):
-            self.kwargs = kwargs
 
-    class EventType:
-        ON_START = "ON_START"
-        ON_STOP = "ON_STOP"
+class EventType:
+    ON_START = "ON_START"
+    ON_STOP = "ON_STOP"
 
-    class MaiMessages:
-        pass
 
-    def register_plugin(cls):
-        return cls
+class MaiMessages:
+    pass
 
-    plugin_system.BasePlugin = BasePlugin
-    plugin_system.BaseEventHandler = BaseEventHandler
-    plugin_system.ComponentInfo = ComponentInfo
-    plugin_system.ConfigField = ConfigField
-    plugin_system.EventType = EventType
-    plugin_system.MaiMessages = MaiMessages
-    plugin_system.register_plugin = register_plugin
-    sys.modules["src.plugin_system"] = plugin_system
 
-    apis = types.ModuleType("src.plugin_system.apis")
+def register_plugin(cls):
+    return cls
 
-    class DummyLogger:
-        def info(self, *_args, **_kwargs):
-            return None
 
-        def warning(self, *_args, **_kwargs):
-            return None
+class DummyLogger:
+    def info(self, *_args, **_kwargs):
+        return None
 
-        def error(self, *_args, **_kwargs):
-            return None
+    def warning(self, *_args, **_kwargs):
+        return None
 
-        def debug(self, *_args, **_kwargs):
-            return None
+    def error(self, *_args, **_kwargs):
+        return None
 
-    class MessageAPI:
-        def __init__(self):
-            self.get_messages_before_time_in_chat = lambda **_kwargs: []
 
-    apis.get_logger = lambda _name: DummyLogger()
-    apis.message_api = MessageAPI()
-    sys.modules["src.plugin_system.apis"] = apis
+class MessageAPI:
+    def __init__(self):
+        self.get_messages_before_time_in_chat = lambda **_kwargs: []
 
-    config_pkg = types.ModuleType("src.config")
-    config_pkg.__path__ = []
-    sys.modules["src.config"] = config_pkg
-    config_mod = types.ModuleType("src.config.config")
-    config_mod.global_config = types.SimpleNamespace(
-        chat=types.SimpleNamespace(max_context_size=20),
-        bot=types.SimpleNamespace(nickname="麦麦"),
-    )
-    sys.modules["src.config.config"] = config_mod
-
-    chat_pkg = types.ModuleType("src.chat")
-    chat_pkg.__path__ = []
-    sys.modules["src.chat"] = chat_pkg
-    chat_utils_pkg = types.ModuleType("src.chat.utils")
-    chat_utils_pkg.__path__ = []
-    sys.modules["src.chat.utils"] = chat_utils_pkg
-
-    chat_builder = types.ModuleType("src.chat.utils.chat_message_builder")
-    chat_builder.replace_user_references = lambda text, _platform, replace_bot_name=True: text
-    sys.modules["src.chat.utils.chat_message_builder"] = chat_builder
-
-    chat_utils = types.ModuleType("src.chat.utils.utils")
-    chat_utils.is_bot_self = lambda _platform, user_id: user_id == "bot-id"
-    chat_utils.translate_timestamp_to_human_readable = lambda ts, mode="relative": f"T{int(ts)}"
-    sys.modules["src.chat.utils.utils"] = chat_utils
-
-    llm_pkg = types.ModuleType("src.llm_models")
-    llm_pkg.__path__ = []
-    sys.modules["src.llm_models"] = llm_pkg
-    payload_pkg = types.ModuleType("src.llm_models.payload_content")
-    payload_pkg.__path__ = []
-    sys.modules["src.llm_models.payload_content"] = payload_pkg
-
-    payload_message_mod = types.ModuleType("src.llm_models.payload_content.message")
-
-    class RoleType(Enum):
-        System = "system"
-        User = "user"
-        Assistant = "assistant"
-        Tool = "tool"
-
-    class Message:
-        def __init__(self, role, content):
-            self.role = role
-            self.content = content
-
-    class MessageBuilder:
-        def __init__(self):
-            self._role = RoleType.User
-            self._content = ""
-
-        def set_role(self, role):
-            self._role = role
-            return self
-
-        def add_text_content(self, text):
-            self._content = text
-            return self
-
-        def build(self):
-            return Message(self._role, self._content)
-
-    payload_message_mod.RoleType = RoleType
-    payload_message_mod.Message = Message
-    payload_message_mod.MessageBuilder = MessageBuilder
-    sys.modules["src.llm_models.payload_content.message"] = payload_message_mod
-
-    model_client_pkg = types.ModuleType("src.llm_models.model_client")
-    model_client_pkg.__path__ = []
-    sys.modules["src.llm_models.model_client"] = model_client_pkg
-
-    model_client_base_mod = types.ModuleType("src.llm_models.model_client.base_client")
-
-    class BaseClient:
-        pass
 
-    model_client_base_mod.BaseClient = BaseClient
-    sys.modules["src.llm_models.model_client.base_client"] = model_client_base_mod
+class RoleType(Enum):
+    System = "system"
+    User = "user"
+    Assistant = "assistant"
 
-    person_pkg = types.ModuleType("src.person_info")
-    person_pkg.__path__ = []
-    sys.modules["src.person_info"] = person_pkg
-    person_mod = types.ModuleType("src.person_info.person_info")
 
-    class Person:
-        def __init__(self, platform, user_id):
-            self.platform = platform
-            self.user_id = user_id
-            self.person_name = ""
+class Message:
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
 
-    person_mod.Person = Person
-    sys.modules["src.person_info.person_info"] = person_mod
 
+class MessageBuilder:
+    def __init__(self):
+        self._role = RoleType.User
+        self._content = ""
 
-def _load_plugin_module():
-    module_name = "llm_message_guard_plugin_under_test"
-    sys.modules.pop(module_name, None)
-    _install_stub_modules()
+    def set_role(self, role):
+        self._role = role
+        return self
 
-    spec = importlib.util.spec_from_file_location(module_name, PLUGIN_PATH)
-    module = importlib.util.module_from_spec(spec)
+    def add_text_content(self, text):
+        self._content = text
+        return self
+
+    def build(self):
+        return Message(self._role, self._content)
+
+
+class BaseClient:
+    pass
+
+
+class Person:
+    def __init__(self, platform, user_id):
+        self.person_name = ""
+
+
+def _module(name: str, is_package: bool = False, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    if is_package:
+        module.__path__ = []
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    return module
+
+
+@functools.cache
+def _build_stubs() -> Dict[str, types.ModuleType]:
+    modules = [
+        _module("src", is_package=True),
+        _module(
+            "src.plugin_system",
+            BasePlugin=BasePlugin,
+            BaseEventHandler=BaseEventHandler,
+            ComponentInfo=ComponentInfo,
+            ConfigField=ConfigField,
+            EventType=EventType,
+            MaiMessages=MaiMessages,
+            register_plugin=register_plugin,
+        ),
+        _module(
+            "src.plugin_system.apis",
+            get_logger=lambda _name: DummyLogger(),
+            message_api=MessageAPI(),
+        ),
+        _module("src.config", is_package=True),
+        _module(
+            "src.config.config",
+            global_config=types.SimpleNamespace(
+                chat=types.SimpleNamespace(max_context_size=20),
+                bot=types.SimpleNamespace(nickname="麦麦"),
+            ),
+        ),
+        _module("src.chat", is_package=True),
+        _module("src.chat.utils", is_package=True),
+        _module(
+            "src.chat.utils.chat_message_builder",
+            replace_user_references=lambda text, _platform, replace_bot_name=True: text,
+        ),
+        _module(
+            "src.chat.utils.utils",
+            is_bot_self=lambda _platform, user_id: user_id == "bot-id",
+            translate_timestamp_to_human_readable=lambda ts, mode="relative": f"T{int(ts)}",
+        ),
+        _module("src.llm_models", is_package=True),
+        _module("src.llm_models.payload_content", is_package=True),
+        _module(
+            "src.llm_models.payload_content.message",
+            RoleType=RoleType,
+            Message=Message,
+            MessageBuilder=MessageBuilder,
+        ),
+        _module("src.llm_models.model_client", is_package=True),
+        _module("src.llm_models.model_client.base_client", BaseClient=BaseClient),
+        _module("src.person_info", is_package=True),
+        _module("src.person_info.person_info", Person=Person),
+    ]
+    return {module.__name__: module for module in modules}
+
+
+# 直接执行预编译的 plugin.py 代码对象，加载时不再访问文件系统
+class _CachedPluginLoader(importlib.abc.Loader):
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(_PLUGIN_CODE, module.__dict__)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_plugin_module():
+    spec = importlib.util.spec_from_loader(
+        "llm_message_guard_plugin_under_test",
+        _CachedPluginLoader(),
+        origin=str(PLUGIN_PATH),
+    )
     assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    module.__file__ = str(PLUGIN_PATH)
     spec.loader.exec_module(module)
     return module
 
 
-def _make_message(user_id: str, nickname: str, content: str, ts: float):
-    user_info = types.SimpleNamespace(
-        platform="qq",
-        user_id=user_id,
-        user_nickname=nickname,
-        user_cardname="",
-    )
-    return types.SimpleNamespace(
-        user_info=user_info,
-        display_message=content,
-        processed_plain_text=content,
-        time=ts,
-    )
+@contextlib.contextmanager
+def _runtime_config(plugin, **overrides):
+    orig = plugin._RUNTIME_CONFIG
+    plugin._RUNTIME_CONFIG = dataclasses.replace(orig, **overrides)
+    try:
+        yield
+    finally:
+        plugin._RUNTIME_CONFIG = orig
+
+
+class _UserInfo:
+    __slots__ = ("platform", "user_id", "user_nickname", "user_cardname")
+
+    def __init__(self, platform, user_id, user_nickname, user_cardname):
+        self.platform = platform
+        self.user_id = user_id
+        self.user_nickname = user_nickname
+        self.user_cardname = user_cardname
+
+
+class _Msg:
+    __slots__ = ("user_info", "display_message", "processed_plain_text", "time", "message_id")
 
+    def __init__(self, user_info, display_message, processed_plain_text, time, message_id):
+        self.user_info = user_info
+        self.display_message = display_message
+        self.processed_plain_text = processed_plain_text
+        self.time = time
+        self.message_id = message_id
+
+
+def _make_message(user_id: str, nickname: str, content: str, ts: float, message_id: str = ""):
+    return _Msg(_UserInfo("qq", user_id, nickname, ""), content, content, ts, message_id)
+
+
+EXPECTED_SPLIT = (
+    (RoleType.System, "sys-prefix"),
+    (RoleType.User, "T1, 小明: 今晚吃啥？"),
+    (RoleType.User, "T2, 麦麦(你):"),
+    (RoleType.Assistant, "火锅可以，我知道一家店"),
+    (RoleType.User, "T3, 小明: 人均大概多少？"),
+    (RoleType.System, "sys-suffix"),
+)
+
+EXPECTED_CONSECUTIVE = (
+    (RoleType.System, "sys-prefix"),
+    (RoleType.User, "T1, 小明: 今晚吃啥？"),
+    (RoleType.User, "T2, 麦麦(你):\nT3, 麦麦(你):"),
+    (RoleType.Assistant, "火锅可以\n我知道一家店"),
+    (RoleType.User, "T4, 小明: 那就去"),
+    (RoleType.System, "sys-suffix"),
+)
+
+HISTORY_SPLIT = (
+    _make_message("u1", "小明", "今晚吃啥？", 1),
+    _make_message("bot-id", "麦麦", "火锅可以，我知道一家店", 2),
+    _make_message("u1", "小明", "人均大概多少？", 3),
+)
+
+HISTORY_CONSECUTIVE = (
+    _make_message("u1", "小明", "今晚吃啥？", 1),
+    _make_message("bot-id", "麦麦", "火锅可以", 2),
+    _make_message("bot-id", "麦麦", "我知道一家店", 3),
+    _make_message("u1", "小明", "那就去", 4),
+)
+
+
+class _PluginTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 桩模块只在本用例类执行期间挂到 sys.modules，结束后自动还原，不污染其他测试文件
+        cls._patcher = mock.patch.dict(sys.modules, _build_stubs())
+        cls._patcher.start()
+        cls.addClassCleanup(cls._patcher.stop)
+
+        cls._plugin_template = _load_plugin_module()
+        cls._self_obj = types.SimpleNamespace(chat_stream=types.SimpleNamespace(stream_id="chat-1"))
+
+        split_result = cls._plugin_template.PromptSplitResult(system_prefix="sys-prefix", system_suffix="sys-suffix")
+        cls._split = staticmethod(lambda _prompt: split_result)
 
-class AssistantHistorySplitTestCase(unittest.TestCase):
     def setUp(self):
-        self.plugin = _load_plugin_module()
-        self.plugin._RUNTIME_CONFIG["merge_consecutive"] = True
-        self.plugin._RUNTIME_CONFIG["max_context_size_override"] = 0
+        self.plugin = self._plugin_template
+
+        # 插件模块在用例间复用，测试会改动的属性在每个用例结束后还原
+        orig_split = self.plugin._split_prompt_blocks
+        orig_get_messages = self.plugin.message_api.get_messages_before_time_in_chat
+        self.addCleanup(setattr, self.plugin, "_split_prompt_blocks", orig_split)
+        self.addCleanup(setattr, self.plugin.message_api, "get_messages_before_time_in_chat", orig_get_messages)
+        self.addCleanup(self.plugin._HISTORY_CACHE.clear)
+
+        self._override_config(merge_consecutive=True, max_context_size_override=0)
+
+    def _override_config(self, **overrides):
+        config_override = _runtime_config(self.plugin, **overrides)
+        config_override.__enter__()
+        self.addCleanup(config_override.__exit__, None, None, None)
+
+    def _use_history(self, history_messages):
+        self.plugin._split_prompt_blocks = self._split
+        self.plugin.message_api.get_messages_before_time_in_chat = lambda **_kwargs: history_messages
+
+
+class AssistantHistorySplitTestCase(_PluginTestCase):
+    def _run_scenario(self, history_messages, expected):
+        self._use_history(history_messages)
+
+        messages = asyncio.run(self.plugin._build_structured_messages(self._self_obj, prompt="dummy"))
+        self.assertEqual(messages, list(expected))
 
     def test_assistant_history_is_split_into_user_prefix_and_assistant_content(self):
+        self._run_scenario(list(HISTORY_SPLIT), EXPECTED_SPLIT)
+
+    def test_consecutive_assistant_history_keeps_alignment_after_split(self):
+        self._run_scenario(list(HISTORY_CONSECUTIVE), EXPECTED_CONSECUTIVE)
+
+    def test_anonymous_senders_keep_their_own_names(self):
         history_messages = [
-            _make_message("u1", "小明", "今晚吃啥？", 1),
-            _make_message("bot-id", "麦麦", "火锅可以，我知道一家店", 2),
-            _make_message("u1", "小明", "人均大概多少？", 3),
+            _make_message("", "无名A", "在吗", 1),
+            _make_message("u1", "小明", "在", 2),
+            _make_message("", "无名B", "好的", 3),
+        ]
+        expected = [
+            (RoleType.System, "sys-prefix"),
+            (RoleType.User, "T1, 无名A: 在吗"),
+            (RoleType.User, "T2, 小明: 在"),
+            (RoleType.User, "T3, 无名B: 好的"),
+            (RoleType.System, "sys-suffix"),
         ]
+        self._run_scenario(history_messages, expected)
 
-        self.plugin._split_prompt_blocks = lambda _prompt: self.plugin.PromptSplitResult(
-            system_prefix="sys-prefix",
-            system_suffix="sys-suffix",
-        )
-        self.plugin.message_api.get_messages_before_time_in_chat = lambda **_kwargs: history_messages
+    def test_person_names_are_resolved_per_sender(self):
+        person_names = {"u1": "小明同学", "u2": "红红"}
+        looked_up = []
 
-        self_obj = types.SimpleNamespace(chat_stream=types.SimpleNamespace(stream_id="chat-1"))
-        messages = self.plugin._build_structured_messages(self_obj, prompt="dummy")
+        class NamedPerson:
+            def __init__(self, platform, user_id):
+                looked_up.append(user_id)
+                self.person_name = person_names.get(user_id, "")
 
+        history_messages = [
+            _make_message("u1", "小明", "今晚吃啥？", 1),
+            _make_message("u2", "小红", "随便", 2),
+            _make_message("bot-id", "麦麦", "火锅", 3),
+            _make_message("u3", "小刚", "   ", 4),
+            _make_message("u1", "小明", "好", 5),
+        ]
         expected = [
-            (self.plugin.RoleType.System, "sys-prefix"),
-            (self.plugin.RoleType.User, "T1, 小明: 今晚吃啥？"),
-            (self.plugin.RoleType.User, "T2, 麦麦(你):"),
-            (self.plugin.RoleType.Assistant, "火锅可以，我知道一家店"),
-            (self.plugin.RoleType.User, "T3, 小明: 人均大概多少？"),
-            (self.plugin.RoleType.System, "sys-suffix"),
+            (RoleType.System, "sys-prefix"),
+            (RoleType.User, "T1, 小明同学: 今晚吃啥？"),
+            (RoleType.User, "T2, 红红: 随便"),
+            (RoleType.User, "T3, 麦麦(你):"),
+            (RoleType.Assistant, "火锅"),
+            (RoleType.User, "T5, 小明同学: 好"),
+            (RoleType.System, "sys-suffix"),
         ]
-        self.assertEqual(messages, expected)
+        with mock.patch.object(self.plugin, "Person", NamedPerson):
+            self._run_scenario(history_messages, expected)
 
-    def test_consecutive_assistant_history_keeps_alignment_after_split(self):
+        # 机器人自身与清洗后为空的发送者不查询 Person，每个发送者只查一次
+        self.assertCountEqual(looked_up, ["u1", "u2"])
+
+    def test_nickname_change_within_window_is_rendered_per_message(self):
         history_messages = [
-            _make_message("u1", "小明", "今晚吃啥？", 1),
-            _make_message("bot-id", "麦麦", "火锅可以", 2),
-            _make_message("bot-id", "麦麦", "我知道一家店", 3),
-            _make_message("u1", "小明", "那就去", 4),
+            _make_message("u1", "小明", "我改个名", 1),
+            _make_message("u1", "明明", "改好了", 2),
+        ]
+        expected = [
+            (RoleType.System, "sys-prefix"),
+            (RoleType.User, "T1, 小明: 我改个名\nT2, 明明: 改好了"),
+            (RoleType.System, "sys-suffix"),
         ]
+        self._run_scenario(history_messages, expected)
 
-        self.plugin._split_prompt_blocks = lambda _prompt: self.plugin.PromptSplitResult(
-            system_prefix="sys-prefix",
-            system_suffix="sys-suffix",
+
+class PatchedGenerateContentTestCase(_PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original = mock.AsyncMock(return_value=("orig", None, "orig-model", None))
+        self.patched = self.plugin._make_patched_llm_generate_content("group", self.original)
+        self.express = mock.AsyncMock(return_value=("  结构化回复 ", ("reasoning", "model", None)))
+        self.replyer = types.SimpleNamespace(
+            chat_stream=types.SimpleNamespace(stream_id="chat-1", group_info=None),
+            express_model=types.SimpleNamespace(generate_response_with_message_async=self.express),
         )
-        self.plugin.message_api.get_messages_before_time_in_chat = lambda **_kwargs: history_messages
+        self._use_history(list(HISTORY_SPLIT))
 
-        self_obj = types.SimpleNamespace(chat_stream=types.SimpleNamespace(stream_id="chat-1"))
-        messages = self.plugin._build_structured_messages(self_obj, prompt="dummy")
+    def _call(self, prompt="dummy"):
+        return asyncio.run(self.patched(self.replyer, prompt))
 
-        expected = [
-            (self.plugin.RoleType.System, "sys-prefix"),
-            (self.plugin.RoleType.User, "T1, 小明: 今晚吃啥？"),
-            (self.plugin.RoleType.User, "T2, 麦麦(你):\nT3, 麦麦(你):"),
-            (self.plugin.RoleType.Assistant, "火锅可以\n我知道一家店"),
-            (self.plugin.RoleType.User, "T4, 小明: 那就去"),
-            (self.plugin.RoleType.System, "sys-suffix"),
+    def test_structured_request_sends_built_messages(self):
+        self.assertEqual(self._call(), ("结构化回复", "reasoning", "model", None))
+        self.original.assert_not_awaited()
+
+        message_factory = self.express.await_args.kwargs["message_factory"]
+        built = [(message.role, message.content) for message in message_factory(None)]
+        self.assertEqual(built, list(EXPECTED_SPLIT))
+
+    def test_disabled_plugin_calls_original(self):
+        self._override_config(enabled=False)
+
+        self.assertEqual(self._call(), ("orig", None, "orig-model", None))
+        self.express.assert_not_awaited()
+
+    def test_rewrite_prompt_skipped_when_apply_rewrite_disabled(self):
+        self._override_config(apply_rewrite=False)
+
+        self.assertEqual(self._call(prompt="改写后的回复："), ("orig", None, "orig-model", None))
+        self.express.assert_not_awaited()
+
+    def test_falls_back_when_prompt_cannot_be_split(self):
+        self.plugin._split_prompt_blocks = lambda _prompt: None
+
+        self.assertEqual(self._call(), ("orig", None, "orig-model", None))
+        self.express.assert_not_awaited()
+
+    def test_falls_back_when_model_request_fails(self):
+        self.express.side_effect = RuntimeError("boom")
+
+        self.assertEqual(self._call(), ("orig", None, "orig-model", None))
+        self.original.assert_awaited_once()
+
+    def test_raises_when_fallback_disabled(self):
+        self._override_config(fallback_to_original=False)
+        self.plugin._split_prompt_blocks = lambda _prompt: None
+
+        with self.assertRaises(RuntimeError):
+            self._call()
+        self.original.assert_not_awaited()
+
+
+class PromptSplitTestCase(_PluginTestCase):
+    def _assert_split(self, prompt, system_prefix, system_suffix):
+        result = self.plugin._split_prompt_blocks(prompt)
+        self.assertEqual(
+            result,
+            self.plugin.PromptSplitResult(system_prefix=system_prefix, system_suffix=system_suffix),
+        )
+
+    def test_split_on_current_time_anchor(self):
+        prompt = (
+            "你是麦麦\n"
+            "当前时间：2024-01-01 12:00\n"
+            "12:00, 小明: 现在几点\n"
+            "12:01, 小红: 不知道\n"
+            "现在请你读读聊天内容\n"
+            "注意不要输出多余内容"
+        )
+        self._assert_split(
+            prompt,
+            "你是麦麦\n当前时间：2024-01-01 12:00",
+            "现在请你读读聊天内容\n注意不要输出多余内容",
+        )
+
+    def test_split_on_chat_header_skips_blank_lines(self):
+        prompt = (
+            "你的人设是麦麦\n"
+            "下面是群里正在聊的内容：\n"
+            "\n"
+            "\n"
+            "3分钟前, 小明: 晚上吃火锅\n"
+            "现在请你对这句内容进行改写：吃火锅\n"
+            "改写后的回复："
+        )
+        self._assert_split(
+            prompt,
+            "你的人设是麦麦\n下面是群里正在聊的内容：",
+            "现在请你对这句内容进行改写：吃火锅\n改写后的回复：",
+        )
+
+    def test_split_falls_back_to_longest_timeline_block(self):
+        prompt = (
+            "你是麦麦\n"
+            "\n"
+            "12:00, 小明: 看这个\n"
+            "[图片1]的内容：一只猫\n"
+            "12:01, 小红: 好可爱\n"
+            "\n"
+            "请给出你的回复"
+        )
+        self._assert_split(prompt, "你是麦麦", "请给出你的回复")
+
+    def test_indented_suffix_line_ends_history(self):
+        prompt = (
+            "当前时间：12:00\n"
+            "12:00, 小明: 在吗\n"
+            "   你正在群里聊天\n"
+            "回复要简短"
+        )
+        self._assert_split(prompt, "当前时间：12:00", "你正在群里聊天\n回复要简短")
+
+    def test_trailing_newline_is_ignored(self):
+        self._assert_split("规则\n当前时间：12:00\n12:00, 小明: 在吗\n", "规则\n当前时间：12:00", "")
+        self._assert_split(
+            "当前时间：12:00\n12:00, 小明: 在吗\n现在请回复\n",
+            "当前时间：12:00",
+            "现在请回复",
+        )
+
+    def test_prompt_without_anchor_returns_none(self):
+        self.assertIsNone(self.plugin._split_prompt_blocks("只是一段说明，提到当前时间：但不在行首\n没有聊天记录"))
+        self.assertIsNone(self.plugin._split_prompt_blocks(""))
+
+
+class HistoryCacheTestCase(_PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build_blocks = mock.Mock(wraps=self.plugin._build_history_blocks)
+        patcher = mock.patch.object(self.plugin, "_build_history_blocks", self.build_blocks)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _build(self, history_messages, stream_id="chat-1"):
+        self._use_history(history_messages)
+        self_obj = types.SimpleNamespace(chat_stream=types.SimpleNamespace(stream_id=stream_id))
+        return asyncio.run(self.plugin._build_structured_messages(self_obj, prompt="dummy"))
+
+    def test_unchanged_window_reuses_rendered_history(self):
+        history_messages = [_make_message("u1", "小明", "在吗", 1, "m1")]
+
+        first = self._build(history_messages)
+        second = self._build(history_messages)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.build_blocks.call_count, 1)
+
+    def test_same_timestamps_with_different_ids_do_not_collide(self):
+        self._build([_make_message("u1", "小明", "在吗", 1, "m1")])
+        messages = self._build([_make_message("u1", "小明", "换了一句", 1, "m2")])
+
+        self.assertIn((RoleType.User, "T1, 小明: 换了一句"), messages)
+        self.assertEqual(self.build_blocks.call_count, 2)
+
+    def test_messages_without_id_are_not_cached(self):
+        history_messages = [_make_message("u1", "小明", "在吗", 1)]
+
+        self._build(history_messages)
+        self._build(history_messages)
+
+        self.assertEqual(self.build_blocks.call_count, 2)
+        self.assertEqual(len(self.plugin._HISTORY_CACHE), 0)
+
+    def test_entry_expires_after_ttl(self):
+        history_messages = [_make_message("u1", "小明", "在吗", 1, "m1")]
+
+        self._build(history_messages)
+        # 把缓存条目的写入时间往前拨到 TTL 之外
+        ((key, (created_at, history_part)),) = self.plugin._HISTORY_CACHE.items()
+        self.plugin._HISTORY_CACHE[key] = (created_at - self.plugin._HISTORY_CACHE_TTL_SECONDS - 1, history_part)
+        self._build(history_messages)
+
+        self.assertEqual(self.build_blocks.call_count, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        windows = [[_make_message("u1", "小明", "在吗", 1, f"m{idx}")] for idx in range(3)]
+
+        with mock.patch.object(self.plugin, "_HISTORY_CACHE_MAX_SIZE", 2):
+            self._build(windows[0])
+            self._build(windows[1])
+            self._build(windows[0])
+            self._build(windows[2])
+            self.assertEqual(self.build_blocks.call_count, 3)
+
+            # windows[1] 最久未使用，已被淘汰；windows[0] 仍在缓存中
+            self._build(windows[0])
+            self.assertEqual(self.build_blocks.call_count, 3)
+            self._build(windows[1])
+            self.assertEqual(self.build_blocks.call_count, 4)
+
+    def test_merge_setting_is_part_of_the_key(self):
+        history_messages = [
+            _make_message("u1", "小明", "在吗", 1, "m1"),
+            _make_message("u1", "小明", "人呢", 2, "m2"),
         ]
-        self.assertEqual(messages, expected)
 
+        merged = self._build(history_messages)
+        self._override_config(merge_consecutive=False)
+        unmerged = self._build(history_messages)
 
-if __name__ == "__main__":
-    unittest.main()
+        self.assertIn((RoleType.User, "T1, 小明: 在吗\nT2, 小明: 人呢"), merged)
+        self.assertIn((RoleType.User, "T1, 小明: 在吗"), unmerged)
+        self.assertEqual(self.build_blocks.call_count, 2)